@@ -1,10 +1,12 @@
 from asheetbly.sheet import Sheet, Interpreter
 
 def run(file):
-	if type(file)==str:
-		with open(file) as f:
-			file=f.readlines()
 	s = Sheet()
-	s.load_csv(file)
+	if isinstance(file,str):
+		# stream straight into csv.reader instead of materializing every line first
+		with open(file,buffering=1024*1024,newline='') as f:
+			s.load_csv(f)
+	else:
+		s.load_csv(file)
 	i = Interpreter(s)
 	i.run()
@@ -1,4 +1,4 @@
-import csv, re, random
+import csv, re, sys, random, functools, operator, linecache
 from string import ascii_uppercase as ALPHABET
 
 A1_NOTATION = re.compile("^([A-Za-z]+)([0-9]+)$")
@@ -19,98 +19,139 @@ class InvalidArgument(Exception):
 	"""Invalid argument given."""
 	pass
 
-def _letters_to_numbers(letters):
-	n = 0
-	for c in letters:
-		tmp = ALPHABET.index(c.upper())+1
-		n = n*26+tmp
-	return n
+_LETTER_VALUES = {c: i+1 for i,c in enumerate(ALPHABET)}
+_LETTER_VALUES.update({c.lower(): n for c,n in _LETTER_VALUES.items()})
+
+# A..Z, then AA..ZZ
+_COLUMN_LETTERS = tuple(ALPHABET)+tuple(a+b for a in ALPHABET for b in ALPHABET)
+
+@functools.lru_cache(maxsize=4096)
+def _a1_to_index(a1):
+	# hand-rolled equivalent of A1_NOTATION, since a program only ever refers to a handful of cells
+	col = 0
+	for i,c in enumerate(a1):
+		n = _LETTER_VALUES.get(c)
+		if n is None: break
+		col = col*26+n
+	else: # no row number
+		raise InvalidA1Notation(a1)
+	row = a1[i:]
+	if not col or not (row.isascii() and row.isdigit()):
+		raise InvalidA1Notation(a1)
+	return col, int(row)
 
 def _numbers_to_letters(numbers):
-	s=""
-	q,r = divmod(numbers,len(ALPHABET))
-	if r==0:
-		q=q-1
-		r=26
-	if q==0:
-		return ALPHABET[r-1]
-	elif q<=len(ALPHABET):
-		return ALPHABET[q-1]+ALPHABET[r-1]
-	else:
-		return _numbers_to_letters(q)+ALPHABET[r-1]
+	if 0<numbers<=len(_COLUMN_LETTERS):
+		return _COLUMN_LETTERS[numbers-1]
+	letters=[]
+	while numbers>0:
+		numbers,r = divmod(numbers-1,len(ALPHABET))
+		letters.append(ALPHABET[r])
+	return "".join(reversed(letters))
 
 def _safe_float(n):
 	try:
 		return float(n)
-	except:
+	except ValueError:
 		return None
 
+def _interpret_row(row):
+	# Sheet.interpret_value for a row of strings, which is all csv.reader gives us (a row at a time, since a call per cell
+	# makes load_csv about 30% slower). Empty cells skip the float() attempt, since a failed float() is the
+	# expensive part. Word-like cells are interned: the same opcodes and labels repeat all over a sheet, and sharing
+	# one string each saves about 30% of a big sheet's memory.
+	return [(text and _safe_float(text)) or (sys.intern(text) if text.isidentifier() else text) for text in row]
+
+def _arithmetic_handler(op):
+	# works on the stack's buffer directly, unless the operands aren't two floats (or aren't there at all)
+	def handler(self,args,stack,ip):
+		b=stack._buf; s=stack.sp
+		if s-2<stack.bottom or b[s-2].__class__ is not float or b[s-1].__class__ is not float:
+			raise self._arithmetic_error(stack)
+		b[s-2]=op(b[s-2],b[s-1])
+		stack.sp=s-1
+		return ip+1
+	return handler
+
 class Stack:
 	"""A stack, with builtin underflow protection."""
-	def __init__(self,values=None):
-		self.values=values or []
+	__slots__ = ("_buf","sp","max","frames","bottom")
+
+	def __init__(self,values=None,size=1024):
+		values=list(values or [])
+		# preallocated buffer with an integer cursor, so pushes and pops never resize a list
+		self.max=max(size,len(values))
+		self._buf=values+[None]*(self.max-len(values))
+		self.sp=len(values)
 		self.frames=[]
+		self.bottom=0 # bottom of the current frame
+
+	@property
+	def values(self):
+		return self._buf[:self.sp]
 
 	def push(self,value):
 		"""Push a value onto the stack."""
-		self.values.append(value)
+		if self.sp>=self.max: self._grow()
+		self._buf[self.sp]=value
+		self.sp+=1
+
+	def _grow(self):
+		self._buf.extend([None]*self.max) # in place, so anyone holding _buf still sees it
+		self.max*=2
 
 	def pop(self):
 		"""Pop a value from the stack, enforcing frames if necessary."""
-		if self.frames: # need to assure we don't underflow
-			if len(self.values)<=self.frames[-1]:
-				raise IndexError("pop from empty list")
-		return self.values.pop(-1)
+		if self.sp<=self.bottom: # need to assure we don't underflow
+			raise IndexError("pop from empty list")
+		self.sp-=1
+		return self._buf[self.sp]
 
 	def popn(self,n):
-		if self.frames: # need to assure we don't underflow
-			assert (len(self.values)-n+1)>self.frames[-1], "Stack underflow!"
-		assert len(self.values)>=n, "Stack underflow!"
-		ret = self.values[-n:]
-		self.values[-n:]=[]
-		return ret
+		assert self.sp-n>=self.bottom, "Stack underflow!"
+		self.sp-=n
+		return self._buf[self.sp:self.sp+n]
 
 	def push_frame(self,args=None):
 		if not args: args=0
-		frametop = len(self.values)-args
-		if self.frames:
-			assert frametop>=self.frames[-1],"Frame overflow!"
-		else:
-			assert frametop>=0,"Frame overflow!"
-		self.frames.append(len(self.values)-args)
+		frametop = self.sp-args
+		assert frametop>=self.bottom,"Frame overflow!"
+		self.frames.append(frametop)
+		self.bottom=frametop
 
 	def pop_frame(self):
-		if self.frames: self.frames.pop()
+		if self.frames:
+			self.frames.pop()
+			self.bottom=self.frames[-1] if self.frames else 0
 
 	def peek(self,n):
-		index=len(self.values)-n
-		if self.frames:
-			if index<=self.frames[1]: raise IndexError()
-		if index<0: raise IndexError()
-		return self.values[index]
+		index=self.sp-n
+		if index<self.bottom: raise IndexError()
+		return self._buf[index]
 
 class Sheet:
 	"""An asheetbly sheet. Contains code."""
+	__slots__ = ("values","version")
+
 	def __init__(self,values=None):
-		self.values=values if values else {}
+		# values are always stored interpreted, in a dict of our own so the caller's isn't rewritten under them
+		self.values={index: self.interpret_value(value) for index,value in values.items()} if values else {}
+		self.version=0 # bumped on every write, so compiled programs know when they're stale
 
 	@staticmethod
 	def a1_to_index(a1):
 		"""Converts A1 syntax into (column, row) index."""
-		if (m:=A1_NOTATION.match(a1)):
-			letters, numbers = m.groups()
-			return _letters_to_numbers(letters), int(numbers)
-		else:
-			raise InvalidA1Notation(a1)
+		return _a1_to_index(a1)
 
 	@staticmethod
 	def index_to_a1(index):
 		"""Converts (column, row) index into A1 syntax."""
-		assert len(index)==2 and all([type(x)==int and x>0 for x in index]), f"Invalid index {index!r}!"
-		return _numbers_to_letters(index[0])+str(index[1])
+		assert len(index)==2 and all(isinstance(x,int) and x>0 for x in index), f"Invalid index {index!r}!"
+		col,row = index
+		return _numbers_to_letters(col)+str(row)
 
 	def interpret_value(self,val):
-		"""Interprets floats/ints as floats and strings as strings."""
+		"""Interprets floats/ints as floats and strings as strings. See _interpret_row for the version load_csv uses."""
 		val=str(val)
 		if (n:=_safe_float(val)):
 			return n
@@ -118,214 +159,554 @@ class Sheet:
 
 	def read(self,index,default=''):
 		"""Reads the value at index, defaulting to default."""
-		return self.interpret_value(self.values.get(tuple(index),default))
+		return self.values.get(tuple(index),default) # already interpreted by write()
 
 	def write(self,index,value):
 		"""Writes value at index."""
 		self.values[tuple(index)]=self.interpret_value(value)
+		self.version+=1
 
 	def load_csv(self,csvfile,dialect="excel",**fmtparams):
 		"""Loads the CSV file into the Sheet. Accepts anything that csv.reader would accept."""
 		rows = csv.reader(csvfile,dialect,**fmtparams)
-		rown=1
-		for row in rows:
-			coln=1
-			for col in row:
-				self.write((coln,rown),col)
-				coln+=1
-			rown+=1
+		# same as calling write() per cell, without the per-cell str() and version bump
+		self.values.update({(coln,rown): value for rown,row in enumerate(rows,1) for coln,value in enumerate(_interpret_row(row),1)})
+		self.version+=1
 
 class Interpreter:
+	__slots__ = ("sheet","_start","ip_col","ip_row","stack","cond","ret_stack","_dispatch","_cell_comparisons","_handlers","_args","_cells","_index","_deps","_stored","_compiled_version","_fault","_plain","_fused")
+
 	def __init__(self,sheet,start=None):
 		self.sheet=sheet
 		if start is None: start=[1,1]
-		if type(start)==str: start=Sheet.a1_to_index(start)
+		if isinstance(start,str): start=Sheet.a1_to_index(start)
 		self._start=start
+		self._dispatch={name[3:]: getattr(self,name) for name in dir(self) if name.startswith("do_")}
+		# COMPARE/LT/GT against a cell, rather than the top two stack items
+		self._cell_comparisons={self.do_COMPARE: self._compare_cell, self.do_LT: self._lt_cell, self.do_GT: self._gt_cell}
+		self._handlers=None
+		self._fault=None # index of the instruction that raised inside a fused block, see _compile_block
 		self.reset()
 
 	def reset(self):
-		self.ip=list(self._start)
+		self.ip_col,self.ip_row=self._start
 		self.stack=Stack()
 		self.cond=False
 		self.ret_stack=[]
 
 	def run(self,start=None):
 		"""Runs the asheetbly program. If start is not given, assumes A1."""
+		stack = self.stack
+		if self._handlers is None or self._compiled_version!=self.sheet.version:
+			self.compile()
 		while True:
-			opcode = self.sheet.read(self.ip,"HALT")
-			if opcode=="HALT" or type(opcode)!=str:
+			handlers, args = self._handlers, self._args
+			ip = self._locate((self.ip_col,self.ip_row))
+			try:
+				while ip>=0: # every handler returns the index of the next instruction
+					ip = handlers[ip](args[ip],stack,ip)
+			except:
+				if self._fault is not None:
+					ip, self._fault = self._fault, None
+				self.ip_col,self.ip_row = self._cells[ip]
+				self._compiled_version = self.sheet.version
+				raise
+			if self._handlers is not None: # halted
+				# any write that touched the program already patched it or forced a recompile, so the program is still current
+				self._compiled_version = self.sheet.version
 				return
-			method = getattr(self,"do_"+opcode.upper())
-			if not method:
-				raise InvalidOpcode(opcode.upper())
-			if not method(self.ip,self.stack):
-				self.ip[1]+=1
+			self.compile() # the program modified itself
+
+	@property
+	def ip(self):
+		"""The (column, row) of the current instruction."""
+		return self.ip_col,self.ip_row
+
+	@ip.setter
+	def ip(self,ip):
+		self.ip_col,self.ip_row = ip
+
+	# Compilation
+
+	def compile(self):
+		"""Compiles the code reachable from the current instruction into a flat program of handlers and their arguments, with arguments resolved ahead of time."""
+		self._compiled_version = self.sheet.version
+		self._cells, self._handlers, self._args = [], [], []
+		self._plain = [] # every slot's (handler, args) before fusion, for _unfuse to put back
+		self._fused = {} # slot -> the fused heads that run it, see _fuse
+		self._index = {}
+		self._deps = set()
+		self._stored = set() # cells some STORE_CELL in the program writes to
+		# lay out everything reachable by falling through or through a constant branch target first,
+		# so every STORE_CELL is known before any instruction's arguments are resolved
+		pending = [(self.ip_col,self.ip_row)]
+		while pending:
+			cell = pending.pop()
+			if cell in self._index: continue
+			for i in range(self._lay_out(cell),len(self._cells)):
+				col,row = cell = self._cells[i]
+				if self._index[cell]!=i: continue # the jump joining this run onto code laid out before
+				opcode = self._opcode(self.sheet.read(cell))
+				if opcode in ("STORE_CELL","JUMP","JUMP_IF","CALL","CALL_IF"):
+					try:
+						address = Sheet.a1_to_index(self.sheet.read((col+1,row)))
+					except (InvalidA1Notation,TypeError):
+						continue # not a constant address, which gets resolved (and checked) at runtime
+					if opcode=="STORE_CELL": self._stored.add(address)
+					else: pending.append(address)
+		for i,cell in enumerate(self._cells):
+			if self._index[cell]==i: # the joining jumps are already compiled
+				self._handlers[i], self._args[i] = self._plain[i] = self._compile_cell(cell)
+		self._fuse_branches()
+		self._fuse_blocks()
+
+	def _lay_out(self,cell):
+		"""Appends the run of code starting at cell to the program, down to the first cell that doesn't fall through, and returns the index of its first instruction."""
+		# laying out whole runs is what lets every handler (bar the last in a run) go on to the next row with just ip+1
+		first = len(self._cells)
+		col,row = cell
+		while True:
+			cell = col,row
+			i = self._index.get(cell)
+			if i is not None: # ran into code that's already laid out, so carry on there
+				self._cells.append(cell)
+				self._handlers.append(self.do_JUMP)
+				self._args.append((i,))
+				self._plain.append((self.do_JUMP,(i,)))
+				return first
+			self._index[cell] = len(self._cells)
+			self._cells.append(cell)
+			self._deps.add(cell)
+			self._handlers.append(self._compile_slot) # compiled when compile() gets to it, or when it first runs
+			self._args.append(())
+			self._plain.append((self._compile_slot,()))
+			if self._opcode(self.sheet.read(cell)) in (None,"HALT"):
+				return first
+			row += 1
+
+	def _locate(self,cell):
+		"""Gets the program index of cell, laying out the code from there if necessary."""
+		i = self._index.get(cell)
+		if i is None:
+			i = self._lay_out(cell)
+		return i
+
+	def _opcode(self,value):
+		"""Gets the name of the opcode in value, or None if it isn't one."""
+		if not isinstance(value,str):
+			return None
+		if value not in self._dispatch: # opcodes are usually written in uppercase already
+			value = value.upper()
+			if value not in self._dispatch: return None
+		return value
+
+	def _compile_cell(self,cell):
+		"""Compiles the instruction at cell into a (handler, args) pair."""
+		value = self.sheet.read(cell,"HALT")
+		opcode = self._opcode(value)
+		if opcode is None:
+			if isinstance(value,str):
+				return self._raise, (InvalidOpcode(value.upper()),)
+			opcode = "HALT"
+		handler = self._dispatch[opcode]
+		compiler = getattr(self,"compile_"+opcode,None)
+		if compiler is None:
+			return handler, ()
+		col,row = cell
+		if (col+1,row) in self._stored or (col+2,row) in self._stored:
+			# the program rewrites this instruction's arguments, so resolve them every time it runs, rather than recompiling every time they change
+			return self._dynamic_arguments, (handler,compiler,cell,opcode in ("JUMP_IF","CALL_IF"))
+		try:
+			args = compiler(cell)
+		except Exception as e: # errors belong to execution, not compilation
+			if opcode in ("JUMP_IF","CALL_IF"): # and a branch's target only matters if it's taken
+				return self._raise_if, (e,)
+			return self._raise, (e,)
+		return self._specialize(handler,args), args
+
+	def _specialize(self,handler,args):
+		"""Picks the form of handler that fits args, so it doesn't have to be worked out on every cycle."""
+		if handler in self._cell_comparisons and args[0] is not None:
+			return self._cell_comparisons[handler]
+		return handler
+
+	def _fuse_branches(self):
+		"""Fuses every TEST/COMPARE/LT/GT directly followed by a JUMP_IF or CALL_IF into one handler that tests and branches."""
+		handlers, args = self._handlers, self._args
+		stack_tests = {self.do_COMPARE: operator.eq, self.do_LT: operator.lt, self.do_GT: operator.gt}
+		cell_tests = {self._compare_cell: operator.eq, self._lt_cell: operator.lt, self._gt_cell: operator.gt}
+		for i in range(len(handlers)-1):
+			handler, branch = handlers[i], handlers[i+1]
+			# the branch keeps its own slot too, for anything that jumps straight to it
+			if branch==self.do_JUMP_IF:
+				target = args[i+1][0]
+				if handler==self.do_TEST:
+					self._fuse(i,self._test_jump_if,(target,),range(i,i+2))
+				elif handler in stack_tests:
+					self._fuse(i,self._compare_jump_if,(stack_tests[handler],target),range(i,i+2))
+				elif handler in cell_tests:
+					self._fuse(i,self._compare_cell_jump_if,(cell_tests[handler],args[i][0],target),range(i,i+2))
+			elif branch==self.do_CALL_IF and (handler==self.do_TEST or handler in stack_tests or handler in cell_tests):
+				self._fuse(i,self._test_call_if,(handler,args[i])+args[i+1],range(i,i+2))
+
+	# opcodes which never branch or write to the sheet, so runs of them can be fused into one handler
+	_straight_line = {"LOAD_CELL","DROP","DUP","OVER","SWAP","ADD","SUB","MULT","DIV","FDIV","MOD","UPPER","LOWER","CONCAT","IN","OUT","TEST","COMPARE","LT","GT","INVERT_COND","RAND","RANDINT"}
+
+	def _fuse_blocks(self):
+		"""Replaces the head of every run of straight-line instructions (and the instruction ending it) with a single generated handler for the whole run."""
+		handlers = self._handlers
+		straight_line_handlers = {self._dispatch[name] for name in self._straight_line}|set(self._cell_comparisons.values())
+		calls = {self.do_CALL,self.do_CALL_IF}
+		branches = {self.do_JUMP,self.do_JUMP_IF}|calls
+		leaders = set() # instructions that can be jumped to start a new block
+		for i,(handler,args) in enumerate(zip(handlers,self._args)):
+			if handler in branches:
+				leaders.add(args[0])
+			if handler in calls:
+				leaders.add(i+1)
+		start = None
+		for i,handler in enumerate(handlers+[None]):
+			straight_line = handler in straight_line_handlers
+			if start is not None and (i in leaders or not straight_line):
+				# whatever ends the run can go in the block too, it returns where to go next itself
+				end = i if straight_line or handler is None else i+1
+				if end-start>1:
+					# a fused test-and-branch ending the block runs the branch after it too
+					covered = end+1 if end-1 in self._fused.get(end-1,()) else end
+					self._fuse(start,self._compile_block(start,end),(),range(start,covered))
+				start = None
+			if straight_line and start is None:
+				start = i
+
+	def _fuse(self,i,handler,args,span):
+		"""Replaces slot i with a fused handler which runs the slots in span."""
+		self._handlers[i], self._args[i] = handler, args
+		for j in span:
+			self._fused.setdefault(j,[]).append(i)
+
+	def _unfuse(self,i):
+		"""Puts back the unfused handler of every fused slot which runs slot i, so i can be changed on its own."""
+		for head in self._fused.pop(i,()):
+			self._handlers[head], self._args[head] = self._plain[head]
+
+	def _patch(self,cell):
+		"""Recompiles the instructions which depend on cell, after a write to it. Returns False if the write changes the program's layout instead, which takes a full recompile."""
+		col,row = cell
+		i = self._index.get(cell)
+		if i is not None and self._opcode(self.sheet.read(cell)) not in (None,"HALT") and self._cells[i+1:i+2]!=[(col,row+1)]:
+			return False # falls through now, but it was the last cell of its run
+		for owner in (cell,(col-1,row),(col-2,row)): # cell as an instruction, or as an argument to one
+			i = self._index.get(owner)
+			if i is not None:
+				self._unfuse(i)
+				self._handlers[i], self._args[i] = self._plain[i] = self._compile_cell(owner)
+		return True
+
+	def _compile_block(self,start,end):
+		"""Generates a handler which runs instructions start to end-1 back to back, without going through the run loop."""
+		names = ["interpreter"]
+		body = []
+		bound = [self]
+		for n,(handler,args) in enumerate(zip(self._handlers[start:end],self._args[start:end])):
+			names += [f"h{n}",f"a{n}"]
+			bound += [handler,args]
+			body.append(f"\t\t\th{n}(a{n},stack,ip+{n})")
+		body[-1] = body[-1].replace("h","return h",1) # the last instruction decides where to go next
+		head = [f"def make_block({','.join(names)}):","\tdef block(args,stack,ip):","\t\ttry:"]
+		first_line = len(head)+1 # instruction n is on line first_line+n, so the line one raised on says which one it was
+		lines = [*head,*body,"\t\texcept BaseException as e:",f"\t\t\tinterpreter._fault = ip+e.__traceback__.tb_lineno-{first_line}","\t\t\traise","\treturn block"]
+		# named after the cell the block starts at, and kept in linecache, so tracebacks through a block show its source
+		filename = f"<asheetbly block {Sheet.index_to_a1(self._cells[start])}>"
+		linecache.cache[filename] = (None,None,[line+"\n" for line in lines],filename)
+		namespace = {}
+		exec(compile("\n".join(lines),filename,"exec"),namespace)
+		return namespace["make_block"](*bound)
+
+	def _compile_slot(self,args,stack,ip):
+		handler, args = self._handlers[ip], self._args[ip] = self._plain[ip] = self._compile_cell(self._cells[ip])
+		return handler(args,stack,ip)
+
+	def _dynamic_arguments(self,args,stack,ip):
+		handler, compiler, cell, conditional = args
+		if conditional and not self.cond: return ip+1 # an untaken branch never reads its target
+		args = compiler(cell) # a branch to code that isn't laid out yet gets laid out from the sheet as it is now
+		return self._specialize(handler,args)(args,stack,ip)
+
+	def _raise(self,args,stack,ip):
+		raise args[0]
+
+	def _raise_if(self,args,stack,ip):
+		if not self.cond: return ip+1
+		raise args[0]
+
+	def _read_argument(self,cell,n,default=''):
+		"""Reads the n-th argument to the instruction at cell, noting the dependency unless the argument is resolved at runtime."""
+		address = cell[0]+n,cell[1]
+		if address not in self._stored: self._deps.add(address)
+		return self.sheet.read(address,default)
+
+	def _address_argument(self,cell,n):
+		return Sheet.a1_to_index(self._read_argument(cell,n))
+
+	def _optional_address_argument(self,cell,n):
+		address = self._read_argument(cell,n)
+		if isinstance(address,str) and A1_NOTATION.fullmatch(address):
+			return Sheet.a1_to_index(address)
+		return None
 
-	@staticmethod
-	def argument(index,n):
-		"""Gets the index of the n-th argument to the instruction at index."""
-		assert len(index)==2 and all([type(x)==int and x>0 for x in index]), f"Invalid index {index!r}!"
-		return index[0]+n,index[1]
+	def compile_LOAD_CELL(self,cell):
+		return (self._address_argument(cell,1),)
 
-	# Memory
+	compile_STORE_CELL = compile_LOAD_CELL
 
-	def do_LOAD_CELL(self,ip,stack):
-		address = Sheet.a1_to_index(self.sheet.read(self.argument(ip,1)))
-		value = self.sheet.read(address)
-		stack.push(value)
+	def compile_IN(self,cell):
+		return (self._read_argument(cell,1).rstrip(),)
 
-	def do_STORE_CELL(self,ip,stack):
-		address = Sheet.a1_to_index(self.sheet.read(self.argument(ip,1)))
-		value = stack.pop()
-		self.sheet.write(address,value)
+	def compile_COMPARE(self,cell):
+		return (self._optional_address_argument(cell,1),)
 
-	# Stack operations
+	compile_LT = compile_GT = compile_COMPARE
 
-	def do_DROP(self,ip,stack):
-		stack.pop()
+	def compile_JUMP(self,cell):
+		return (self._locate(self._address_argument(cell,1)),)
 
-	def do_DUP(self,ip,stack):
-		stack.push(stack.peek(1))
+	compile_JUMP_IF = compile_JUMP
 
-	def do_OVER(self,ip,stack):
-		stack.push(stack.peek(2))
+	def compile_CALL(self,cell):
+		address = self._address_argument(cell,1)
+		args = self._read_argument(cell,2,0)
+		if isinstance(args,str): args=0
+		return self._locate(address), args
 
-	def do_SWAP(self,ip,stack):
-		for item in stack.popn(2)[::-1]:
-			stack.push(item)
+	compile_CALL_IF = compile_CALL
 
-	# Arithmetic
+	def compile_RAND(self,cell):
+		m = self._read_argument(cell,1,0)
+		n = self._read_argument(cell,2,1)
+		if not isinstance(m,float): m=0
+		if not isinstance(n,float): n=1
+		return m, n
 
-	def _binary_arithmetic_check(self,stack):
-		items = stack.popn(2)
-		if not all([type(item)==float for item in items]): raise ArithmeticError(f"Attempt to perform arithmetic on strings (items: {items!r})")
-		return items
+	def compile_RANDINT(self,cell):
+		m = self._read_argument(cell,1)
+		n = self._read_argument(cell,2)
+		if not isinstance(m,float): raise InvalidArgument(f"Argument #1 to RANDINT must be number (is {m!r}).")
+		m=int(m)
+		if not isinstance(n,float): n=None
+		else: n=int(n)
+		if m and not n:
+			n=m
+			m=1
+		return m, n
 
-	def do_ADD(self,ip,stack):
-		item1,item2 = self._binary_arithmetic_check(stack)
-		stack.push(item1+item2)
+	# Memory
 
-	def do_SUB(self,ip,stack):
-		item1,item2 = self._binary_arithmetic_check(stack)
-		stack.push(item1-item2)
+	# cells are stored interpreted and compiled addresses are already tuples, so the hot handlers
+	# below read straight out of sheet.values instead of going through Sheet.read
 
-	def do_MULT(self,ip,stack):
-		item1,item2 = self._binary_arithmetic_check(stack)
-		stack.push(item1*item2)
+	def do_LOAD_CELL(self,args,stack,ip):
+		stack.push(self.sheet.values.get(args[0],""))
+		return ip+1
 
-	def do_DIV(self,ip,stack):
-		item1,item2 = self._binary_arithmetic_check(stack)
-		stack.push(item1/item2)
+	def do_STORE_CELL(self,args,stack,ip):
+		address = args[0]
+		value = stack.pop()
+		self.sheet.write(address,value)
+		if address in self._deps and not self._patch(address): # self-modifying code that changes the layout, recompile from the next instruction
+			col,row = self._cells[ip]
+			self.ip_col,self.ip_row = col,row+1
+			self._handlers = None
+			return -1
+		return ip+1
+
+	# Stack operations
+
+	def do_DROP(self,args,stack,ip):
+		stack.pop()
+		return ip+1
+
+	# DUP, OVER and SWAP work on the stack's buffer directly, checking for underflow once up front
+
+	def do_DUP(self,args,stack,ip):
+		b=stack._buf; s=stack.sp
+		if s-1<stack.bottom: raise IndexError()
+		if s>=stack.max: stack._grow()
+		b[s]=b[s-1]
+		stack.sp=s+1
+		return ip+1
+
+	def do_OVER(self,args,stack,ip):
+		b=stack._buf; s=stack.sp
+		if s-2<stack.bottom: raise IndexError()
+		if s>=stack.max: stack._grow()
+		b[s]=b[s-2]
+		stack.sp=s+1
+		return ip+1
+
+	def do_SWAP(self,args,stack,ip):
+		b=stack._buf; s=stack.sp
+		assert s-2>=stack.bottom, "Stack underflow!"
+		b[s-1],b[s-2]=b[s-2],b[s-1]
+		return ip+1
+
+	# Arithmetic
+
+	def _arithmetic_error(self,stack):
+		"""Pops the operands of an arithmetic instruction that can't go ahead, and returns the error to raise (popn raises on underflow itself)."""
+		items = stack.popn(2)
+		return ArithmeticError(f"Attempt to perform arithmetic on strings (items: {items!r})")
 
-	def do_FDIV(self,ip,stack):
-		item1,item2 = self._binary_arithmetic_check(stack)
-		stack.push(item1/item2)
+	# ADD/SUB/MULT/DIV/FDIV/MOD share one handler shape, see _arithmetic_handler
 
-	def do_MOD(self,ip,stack):
-		item1,item2 = self._binary_arithmetic_check(stack)
-		stack.push(item1%item2)
+	do_ADD = _arithmetic_handler(operator.add)
+	do_SUB = _arithmetic_handler(operator.sub)
+	do_MULT = _arithmetic_handler(operator.mul)
+	do_DIV = _arithmetic_handler(operator.truediv)
+	do_FDIV = do_DIV # not floordiv, FDIV has always divided like DIV
+	do_MOD = _arithmetic_handler(operator.mod)
 
 	# String operations
 
-	def do_UPPER(self,ip,stack):
+	def do_UPPER(self,args,stack,ip):
 		stack.push(str(stack.pop()).upper())
+		return ip+1
 
-	def do_LOWER(self,ip,stack):
+	def do_LOWER(self,args,stack,ip):
 		stack.push(str(stack.pop()).lower())
+		return ip+1
 
-	def do_CONCAT(self,ip,stack):
+	def do_CONCAT(self,args,stack,ip):
 		item1,item2 = map(str,stack.popn(2))
 		stack.push(self.sheet.interpret_value(item1+item2))
+		return ip+1
 
 	# I/O Operations
 
-	def do_IN(self,ip,stack):
-		prompt=self.sheet.read(self.argument(ip,1)).rstrip()
-		stack.push(self.sheet.interpret_value(input(prompt+" ")))
+	def do_IN(self,args,stack,ip):
+		stack.push(self.sheet.interpret_value(input(args[0]+" ")))
+		return ip+1
 
-	def do_OUT(self,ip,stack):
+	def do_OUT(self,args,stack,ip):
 		print(stack.pop())
+		return ip+1
 
 	# Control Flow
 
-	def do_TEST(self,ip,stack):
+	def do_TEST(self,args,stack,ip):
 		self.cond=(stack.peek(1)==0)
+		return ip+1
 
-	def do_COMPARE(self,ip,stack):
-		address = self.sheet.read(self.argument(ip,1))
-		try:
-			address = self.sheet.a1_to_index(address)
-			value = self.sheet.read(address)
-			self.cond=(stack.peek(1)==value)
-		except:
-			self.cond=(stack.peek(2)==stack.peek(1))
-
-	def do_LT(self,ip,stack):
-		address = self.sheet.read(self.argument(ip,1))
-		try:
-			address = self.sheet.a1_to_index(address)
-			value = self.sheet.read(address)
-			self.cond=(stack.peek(1)<value)
-		except:
-			self.cond=(stack.peek(2)<stack.peek(1))
+	# COMPARE/LT/GT with an address argument are compiled to the _cell forms below instead, see _specialize
 
-	def do_GT(self,ip,stack):
-		address = self.sheet.read(self.argument(ip,1))
-		try:
-			address = self.sheet.a1_to_index(address)
-			value = self.sheet.read(address)
-			self.cond=(stack.peek(1)>value)
-		except:
-			self.cond=(stack.peek(2)>stack.peek(1))
+	def do_COMPARE(self,args,stack,ip):
+		self.cond=(stack.peek(2)==stack.peek(1))
+		return ip+1
 
-	def do_INVERT_COND(self,ip,stack):
-		self.cond=not self.cond
+	def _compare_cell(self,args,stack,ip):
+		self.cond=(stack.peek(1)==self.sheet.values.get(args[0],""))
+		return ip+1
 
-	def do_JUMP(self,ip,stack):
-		address = self.sheet.a1_to_index(self.sheet.read(self.argument(ip,1)))
-		self.ip = list(address)
-		return True # don't auto-increment
+	def do_LT(self,args,stack,ip):
+		self.cond=(stack.peek(2)<stack.peek(1))
+		return ip+1
 
-	def do_JUMP_IF(self,ip,stack):
-		if self.cond: return self.do_JUMP(ip,stack)
+	def _lt_cell(self,args,stack,ip):
+		try:
+			self.cond=(stack.peek(1)<self.sheet.values.get(args[0],""))
+		except TypeError: # the cell's value can't be compared with the top item, so compare the top two items instead
+			self.cond=(stack.peek(2)<stack.peek(1))
+		return ip+1
 
-	def do_CALL(self,ip,stack):
-		address = self.sheet.a1_to_index(self.sheet.read(self.argument(ip,1)))
-		args = self.sheet.read(self.argument(ip,2),0)
-		if type(args)==str: args=0
-		self.stack.push_frame(args)
-		self.ret_stack.append(self.ip)
-		self.ip = list(address)
-		return True # don't auto-increment
+	def do_GT(self,args,stack,ip):
+		self.cond=(stack.peek(2)>stack.peek(1))
+		return ip+1
 
-	def do_CALL_IF(self,ip,stack):
-		if self.cond: return self.do_CALL(ip,stack)
+	def _gt_cell(self,args,stack,ip):
+		try:
+			self.cond=(stack.peek(1)>self.sheet.values.get(args[0],""))
+		except TypeError: # same as _lt_cell
+			self.cond=(stack.peek(2)>stack.peek(1))
+		return ip+1
 
-	def do_RETURN(self,ip,stack):
-		self.ip = self.ret_stack.pop()
-		self.stack.pop_frame()
-		# let auto-increment happen, since the IP we pushed was the CALL instruction
+	def do_INVERT_COND(self,args,stack,ip):
+		self.cond=not self.cond
+		return ip+1
+
+	def do_JUMP(self,args,stack,ip):
+		return args[0]
+
+	def do_JUMP_IF(self,args,stack,ip):
+		return args[0] if self.cond else ip+1
+
+	# fused test-and-branch superinstructions, see _fuse_branches
+	# these still set COND, since whatever runs next may read it
+
+	def _test_jump_if(self,args,stack,ip):
+		s=stack.sp
+		if s-1<stack.bottom: raise IndexError()
+		self.cond=cond=(stack._buf[s-1]==0)
+		return args[0] if cond else ip+2
+
+	def _compare_jump_if(self,args,stack,ip):
+		op, target = args
+		s=stack.sp
+		if s-2<stack.bottom: raise IndexError()
+		self.cond=cond=op(stack._buf[s-2],stack._buf[s-1])
+		return target if cond else ip+2
+
+	def _compare_cell_jump_if(self,args,stack,ip):
+		op, address, target = args
+		s=stack.sp
+		if s-1<stack.bottom: raise IndexError()
+		try:
+			cond=op(stack._buf[s-1],self.sheet.values.get(address,""))
+		except TypeError: # same as _lt_cell
+			if s-2<stack.bottom: raise IndexError()
+			cond=op(stack._buf[s-2],stack._buf[s-1])
+		self.cond=cond
+		return target if cond else ip+2
+
+	def _test_call_if(self,args,stack,ip):
+		test, test_args, target, nargs = args
+		test(test_args,stack,ip)
+		if not self.cond: return ip+2
+		stack.push_frame(nargs)
+		self.ret_stack.append(self._cells[ip+1])
+		return target
+
+	def do_CALL(self,args,stack,ip):
+		target, nargs = args
+		stack.push_frame(nargs)
+		self.ret_stack.append(self._cells[ip])
+		return target
+
+	def do_CALL_IF(self,args,stack,ip):
+		if not self.cond: return ip+1
+		# same as do_CALL, inlined to save a method call per taken branch
+		target, nargs = args
+		stack.push_frame(nargs)
+		self.ret_stack.append(self._cells[ip])
+		return target
+
+	def do_RETURN(self,args,stack,ip):
+		col,row = self.ret_stack.pop()
+		stack.pop_frame()
+		return self._locate((col,row+1)) # the cell we pushed was the CALL instruction
+
+	def do_HALT(self,args,stack,ip):
+		self.ip_col,self.ip_row = self._cells[ip]
+		return -1
 
 	# Random Number Generation
 
-	def do_RAND(self,ip,stack):
-		m = self.sheet.read(self.argument(ip,1),0)
-		n = self.sheet.read(self.argument(ip,2),1)
-		if type(m)!=float: m=0
-		if type(n)!=float: n=1
+	def do_RAND(self,args,stack,ip):
+		m, n = args
 		if m==0 and n==1:
 			stack.push(random.random())
 		else:
 			stack.push(random.uniform(m,n))
+		return ip+1
 
-	def do_RANDINT(self,ip,stack):
-		m = self.sheet.read(self.argument(ip,1))
-		n = self.sheet.read(self.argument(ip,2))
-		if type(m)!=float: raise InvalidArgument(f"Argument #1 to RANDINT must be number (is {m!r}).")
-		m=int(m)
-		if type(n)!=float: n=None
-		else: n=int(n)
-		if m and not n:
-			n=m
-			m=1
-		stack.push(random.randint(m,n))
+	def do_RANDINT(self,args,stack,ip):
+		stack.push(random.randint(*args))
+		return ip+1
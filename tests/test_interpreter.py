@@ -0,0 +1,140 @@
+import io, contextlib, traceback, unittest
+from unittest import mock
+from asheetbly.sheet import Sheet, Interpreter, Stack, InvalidA1Notation, InvalidOpcode, ArithmeticError
+
+def make_sheet(cells):
+	"""Builds a Sheet from {"A1": value} cells."""
+	return Sheet({Sheet.a1_to_index(a1): value for a1,value in cells.items()})
+
+def run(interpreter,inputs=()):
+	"""Runs interpreter, feeding it inputs, and returns what it printed."""
+	out = io.StringIO()
+	with contextlib.redirect_stdout(out), mock.patch("builtins.input",side_effect=list(inputs)):
+		interpreter.run()
+	return out.getvalue()
+
+class TestSheet(unittest.TestCase):
+	def test_init_leaves_callers_dict_alone(self):
+		values = {(1,1): 3, (1,2): "x"}
+		sheet = Sheet(values)
+		self.assertEqual(values, {(1,1): 3, (1,2): "x"})
+		self.assertEqual(sheet.values, {(1,1): 3.0, (1,2): "x"})
+
+	def test_index_to_a1_round_trips(self):
+		for col in (1,26,27,52,702,703,18278,18279):
+			self.assertEqual(Sheet.a1_to_index(Sheet.index_to_a1((col,7))), (col,7))
+		self.assertEqual(Sheet.index_to_a1((703,1)), "AAA1")
+
+	def test_load_csv_interprets_values(self):
+		sheet = Sheet()
+		sheet.load_csv(["OUT,1.5,,hi there,0"])
+		self.assertEqual(sheet.values, {(1,1): "OUT", (2,1): 1.5, (3,1): "", (4,1): "hi there", (5,1): "0"})
+		self.assertEqual(sheet.version, 1)
+
+class TestInterpreter(unittest.TestCase):
+	def test_ip_can_be_set_before_running(self):
+		interpreter = Interpreter(make_sheet({"A1":"LOAD_CELL","B1":"D1","A2":"OUT","A3":"LOAD_CELL","B3":"D2","A4":"OUT","D1":"one","D2":"two"}))
+		interpreter.ip = [1,3]
+		self.assertEqual(run(interpreter), "two\n")
+		self.assertEqual(interpreter.ip, (1,5))
+
+	def test_invalid_opcode_raises(self):
+		interpreter = Interpreter(make_sheet({"A1":"bogus"}))
+		with self.assertRaises(InvalidOpcode):
+			run(interpreter)
+
+	def test_lowercase_opcodes(self):
+		interpreter = Interpreter(make_sheet({"A1":"load_cell","B1":"D1","A2":"out","A3":"halt","A4":"bogus","D1":"hi"}))
+		self.assertEqual(run(interpreter), "hi\n")
+
+	def test_far_off_data_words_are_not_compiled(self):
+		sheet = make_sheet({"A1":"LOAD_CELL","B1":"B2","A2":"OUT","B2":"hi"})
+		sheet.write(Sheet.a1_to_index("AN1000000"), "Test")
+		interpreter = Interpreter(sheet)
+		self.assertEqual(run(interpreter), "hi\n")
+		self.assertLess(len(interpreter._cells), 10)
+
+	def test_untaken_branch_with_bad_target(self):
+		interpreter = Interpreter(make_sheet({"A1":"LOAD_CELL","B1":"D1","A2":"JUMP_IF","A3":"OUT","D1":"hi"}))
+		self.assertEqual(run(interpreter), "hi\n")
+
+	def test_taken_branch_with_bad_target(self):
+		interpreter = Interpreter(make_sheet({"A1":"INVERT_COND","A2":"JUMP_IF","B2":"nowhere"}))
+		with self.assertRaises(InvalidA1Notation):
+			run(interpreter)
+		self.assertEqual(interpreter.ip, (1,2))
+
+	def test_untaken_rewritten_branch(self):
+		# B3 is rewritten with a number, which isn't an address, but the CALL_IF isn't taken
+		interpreter = Interpreter(make_sheet({"A1":"LOAD_CELL","B1":"D1","A2":"STORE_CELL","B2":"B3","A3":"CALL_IF","B3":"E1",
+			"A4":"LOAD_CELL","B4":"D2","A5":"OUT","D1":"7","D2":"fell through"}))
+		self.assertEqual(run(interpreter), "fell through\n")
+
+	def test_rewritten_branch_to_new_code(self):
+		# stores OUT into the spare cell F1, points the JUMP at it, and jumps there
+		interpreter = Interpreter(make_sheet({"A1":"LOAD_CELL","B1":"Z1","A2":"STORE_CELL","B2":"F1","A3":"LOAD_CELL","B3":"Z2","A4":"STORE_CELL","B4":"B7",
+			"A5":"LOAD_CELL","B5":"Z3","A6":"CALL","B6":"H1","A7":"JUMP","B7":"A8","A8":"HALT","H1":"RETURN","Z1":"OUT","Z2":"F1","Z3":"hi"}))
+		self.assertEqual(run(interpreter), "hi\n")
+		self.assertEqual(interpreter.ip, (6,2))
+
+	def test_cell_comparison_falls_back_to_stack(self):
+		# 1 < "hi" can't be compared, so LT compares the top two items (1 < 2) instead
+		for branch in ("JUMP_IF","INVERT_COND"): # fused with its test, and not
+			interpreter = Interpreter(make_sheet({"A1":"LOAD_CELL","B1":"Z1","A2":"LOAD_CELL","B2":"Z2","A3":"LT","B3":"Z3","A4":branch,"B4":"A6",
+				"A5":"HALT","A6":"HALT","Z1":"1","Z2":"2","Z3":"hi"}))
+			run(interpreter)
+			self.assertEqual(interpreter.ip, (1,6) if branch=="JUMP_IF" else (1,5))
+
+	def test_error_in_fused_block_reports_its_instruction(self):
+		interpreter = Interpreter(make_sheet({"A1":"LOAD_CELL","B1":"D1","A2":"OUT","A3":"LOAD_CELL","B3":"D1","A4":"LOAD_CELL","B4":"D2","A5":"ADD",
+			"D1":"1","D2":"hi"}))
+		try:
+			run(interpreter)
+		except ArithmeticError as e: # not assertRaises, which drops the traceback
+			self.assertIn("<asheetbly block A1>", "".join(traceback.format_exception(e)))
+		else:
+			self.fail("ArithmeticError not raised")
+		self.assertEqual(interpreter.ip, (1,5))
+		# running again carries on from the failed instruction, rather than printing again
+		interpreter.sheet.write(Sheet.a1_to_index("D2"), 2)
+		interpreter.stack = Stack([1.0,2.0])
+		self.assertEqual(run(interpreter), "")
+
+	def test_self_modified_instruction_is_patched(self):
+		# each pass swaps A2 between OUT and DROP, so only every other pass prints
+		interpreter = Interpreter(make_sheet({"A1":"LOAD_CELL","B1":"Y1","A2":"OUT","A3":"LOAD_CELL","B3":"A2","A4":"LOAD_CELL","B4":"Z3",
+			"A5":"STORE_CELL","B5":"A2","A6":"STORE_CELL","B6":"Z3","A7":"LOAD_CELL","B7":"Z1","A8":"LOAD_CELL","B8":"Z2","A9":"SUB","A10":"DUP",
+			"A11":"STORE_CELL","B11":"Z1","A12":"GT","B12":"Z5","A13":"DROP","A14":"JUMP_IF","B14":"A1","A15":"HALT",
+			"Y1":"x","Z1":"4","Z2":"1","Z3":"DROP","Z5":"0.5"}))
+		with mock.patch.object(Interpreter,"compile",autospec=True,side_effect=Interpreter.compile) as compile:
+			self.assertEqual(run(interpreter), "x\nx\n")
+		self.assertEqual(compile.call_count, 1)
+
+	def test_self_modification_extending_a_run(self):
+		# A4 starts out empty, so the run ends there until the program writes OUT into it
+		interpreter = Interpreter(make_sheet({"A1":"LOAD_CELL","B1":"Z2","A2":"LOAD_CELL","B2":"Z1","A3":"STORE_CELL","B3":"A4","A4":"","A5":"HALT",
+			"Z1":"OUT","Z2":"hi"}))
+		self.assertEqual(run(interpreter), "hi\n")
+		self.assertEqual(interpreter.ip, (1,5))
+
+class TestArithmetic(unittest.TestCase):
+	def test_errors(self):
+		interpreter = Interpreter(Sheet())
+		for handler in (interpreter.do_ADD,interpreter.do_SUB,interpreter.do_MULT,interpreter.do_DIV,interpreter.do_FDIV,interpreter.do_MOD):
+			with self.assertRaises(AssertionError):
+				handler((),Stack([1.0]),0)
+			for values in ([1.0,"x"],[1,1.0]): # strings, and RANDINT's ints
+				stack = Stack(values)
+				with self.assertRaises(ArithmeticError):
+					handler((),stack,0)
+				self.assertEqual(stack.values, [])
+
+	def test_results(self):
+		interpreter = Interpreter(Sheet())
+		for handler,result in ((interpreter.do_ADD,9.0),(interpreter.do_SUB,5.0),(interpreter.do_MULT,14.0),(interpreter.do_DIV,3.5),(interpreter.do_FDIV,3.5),(interpreter.do_MOD,1.0)):
+			stack = Stack([7.0,2.0])
+			self.assertEqual(handler((),stack,0), 1)
+			self.assertEqual(stack.values, [result])
+
+if __name__=="__main__":
+	unittest.main()
@@ -0,0 +1,115 @@
+import io, glob, random, signal, contextlib, unittest
+from unittest import mock
+from asheetbly import sheet
+from tests import reference
+
+# inputs for the examples that read any, the guessing game just guesses upwards until it gets it
+INPUTS = {"helloname.csv": ["world"], "guessinggame.csv": [str(n) for n in range(1,101)]}
+
+OPCODES = ["LOAD_CELL","STORE_CELL","DROP","DUP","OVER","SWAP","ADD","SUB","MULT","DIV","FDIV","MOD","UPPER","LOWER","CONCAT",
+	"OUT","TEST","COMPARE","LT","GT","INVERT_COND","JUMP","JUMP_IF","CALL","CALL_IF","RETURN","RAND","RANDINT","HALT"]
+COLS, ROWS = 7, 9
+
+class Timeout(Exception):
+	pass
+
+def random_program(r):
+	"""Code in columns A and D, with random addresses, numbers and strings around it."""
+	cells = {}
+	for col in range(1,COLS+1):
+		for row in range(1,ROWS+1):
+			if col in (1,4) and r.random()<.8:
+				cells[(col,row)] = r.choice(OPCODES+[""])
+			elif r.random()<.5:
+				cells[(col,row)] = r.choice([r.choice("ABCDEFG")+str(r.randint(1,ROWS)),r.choice(["0","1","2","0.5","-1"]),r.choice(OPCODES),"hi",""])
+	return cells
+
+def self_modifying_program(r):
+	"""Code in columns A and D which copies values from column G over its own instructions and arguments."""
+	cells = {}
+	for col in (1,4):
+		row = 1
+		while row<=ROWS:
+			if r.random()<.35 and row<ROWS:
+				cells[(col,row)], cells[(col+1,row)] = "LOAD_CELL", "G"+str(r.randint(1,ROWS))
+				cells[(col,row+1)], cells[(col+1,row+1)] = "STORE_CELL", r.choice("ABDE")+str(r.randint(1,ROWS))
+				row += 2
+				continue
+			opcode = r.choice(["OUT","DUP","TEST","INVERT_COND","JUMP_IF","JUMP","LOAD_CELL","UPPER","CALL_IF","RETURN","HALT",""])
+			cells[(col,row)] = opcode
+			if opcode in ("JUMP_IF","JUMP","LOAD_CELL","CALL_IF"):
+				cells[(col+1,row)] = r.choice("ADG")+str(r.randint(1,ROWS))
+			row += 1
+	for row in range(1,ROWS+1):
+		cells[(7,row)] = r.choice(OPCODES+["A1","D1","A"+str(r.randint(1,ROWS)),"D"+str(r.randint(1,ROWS)),"hi","1",""])
+	return cells
+
+def to_csv(cells):
+	return [",".join('"%s"'%cells.get((col,row),"") for col in range(1,COLS+1)) for row in range(1,ROWS+1)]
+
+def execute(module,lines,inputs=(),seed=0,runs=1):
+	"""Runs the program in lines with module's interpreter, and returns what every run printed, raised and stopped at, and the sheet after."""
+	s = module.Sheet()
+	s.load_csv(lines)
+	interpreter = module.Interpreter(s)
+	random.seed(seed)
+	results = []
+	with mock.patch("builtins.input",side_effect=list(inputs)):
+		for attempt in range(runs):
+			out = io.StringIO()
+			error = None
+			try:
+				with contextlib.redirect_stdout(out):
+					interpreter.run()
+			except Timeout:
+				raise
+			except Exception as e:
+				error = type(e).__name__
+				if error=="AttributeError": error = "InvalidOpcode" # the reference looks unknown opcodes up with getattr
+			results.append((out.getvalue(),error,tuple(interpreter.ip),dict(s.values)))
+			if error is None: break
+	return results
+
+class TestExamples(unittest.TestCase):
+	def test_examples(self):
+		for path in sorted(glob.glob("examples/*.csv")):
+			name = path.rsplit("/",1)[-1]
+			with self.subTest(name):
+				with open(path,newline='') as f:
+					lines = list(f)
+				inputs = INPUTS.get(name,())
+				self.assertEqual(execute(sheet,lines,inputs), execute(reference,lines,inputs))
+
+@unittest.skipUnless(hasattr(signal,"setitimer"), "needs signal.setitimer to stop programs that never halt")
+class TestRandomPrograms(unittest.TestCase):
+	"""Runs random programs on both interpreters, which have to agree on everything bar programs that never halt."""
+	count = 300
+
+	def setUp(self):
+		def alarm(signum,frame):
+			raise Timeout()
+		previous = signal.signal(signal.SIGALRM,alarm)
+		self.addCleanup(signal.signal,signal.SIGALRM,previous)
+
+	def check(self,generator):
+		for seed in range(self.count):
+			lines = to_csv(generator(random.Random(seed)))
+			# the reference's bare excepts can swallow the alarm, so it keeps going off until a run gives up
+			signal.setitimer(signal.ITIMER_REAL,0.2,0.05)
+			try:
+				expected = execute(reference,lines,seed=seed,runs=2)
+				got = execute(sheet,lines,seed=seed,runs=2)
+			except Timeout:
+				continue
+			finally:
+				signal.setitimer(signal.ITIMER_REAL,0)
+			self.assertEqual(got, expected, f"seed {seed}")
+
+	def test_random_programs(self):
+		self.check(random_program)
+
+	def test_self_modifying_programs(self):
+		self.check(self_modifying_program)
+
+if __name__=="__main__":
+	unittest.main()